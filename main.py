@@ -1,40 +1,97 @@
 import os
-import json
+import asyncio
+import orjson
 import logging
+import aiohttp
 import requests
 import pandas as pd
+import polars as pl
+import pyarrow as pa
+import pyarrow.csv as pacsv
 from datetime import datetime, timedelta
 from google.cloud import storage
-from io import StringIO
+from io import BytesIO
 import calendar
+import itertools
 from google.api_core.exceptions import NotFound, Forbidden, GoogleAPIError
 import unittest
 import pandas as pd
 from datetime import datetime
-import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 
-def download_and_process_csv_for_date(bucket_name, service_account_info, target_date):
+# Maximum number of dimension records sent per Planhat POST
+PLANHAT_BATCH_SIZE = 1000
+
+# Maximum number of concurrent connections used for Planhat uploads
+PLANHAT_UPLOAD_CONNECTIONS = 32
+
+# Retry policy for the async uploads, mirroring the shared session's Retry
+PLANHAT_UPLOAD_RETRIES = 5
+PLANHAT_UPLOAD_BACKOFF = 0.3
+
+# HTTP statuses worth retrying (rate limits and transient server errors)
+PLANHAT_RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+# Shared session so TCP/TLS connections are reused across all Planhat calls,
+# with automatic backed-off retries on rate limits and transient server errors
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.3,
+        status_forcelist=PLANHAT_RETRY_STATUSES,
+        allowed_methods=['GET', 'POST']
+    )
+))
+
+@lru_cache(maxsize=1)
+def _gcs_client(service_account_json):
+    """
+    Builds the storage client once per instance and reuses it afterwards.
+
+    Keyed by the raw service-account JSON string (hashable), so warm Cloud
+    Function invocations skip re-parsing the key, rebuilding the signer, and
+    reopening the underlying connection pool.
+    """
+    return storage.Client.from_service_account_info(orjson.loads(service_account_json))
+
+def download_and_process_csv_for_date(bucket_name, service_account_json, target_date):
     """
     Downloads and processes the CSV file for a particular date from a GCP bucket directly in memory.
     """
     try:
-        # Create the storage client using the service account info (as dictionary)
-        storage_client = storage.Client.from_service_account_info(service_account_info)
-        bucket = storage_client.get_bucket(bucket_name)
+        storage_client = _gcs_client(service_account_json)
         logging.info(f"Accessing bucket '{bucket_name}' for files with date {target_date}.")
 
-        blobs = bucket.list_blobs()
+        # Filter server-side so the API only returns the day's CSV candidates,
+        # instead of listing every object in the bucket and filtering in Python
+        blobs = storage_client.list_blobs(bucket_name, prefix=target_date, match_glob='**.csv')
         for blob in blobs:
-            if target_date in blob.name and blob.name.endswith('.csv'):
-                logging.info(f"Found file: {blob.name}")
-                # Download the CSV content as a string and process it in memory
-                csv_content = blob.download_as_string().decode('utf-8')
-                df = pd.read_csv(StringIO(csv_content))
-                logging.info("File processed successfully in memory.")
-                return df  # Return the DataFrame
+            logging.info(f"Found file: {blob.name}")
+            # Stream the blob through pyarrow's chunked CSV reader so peak
+            # memory is bounded by the block size rather than the file size;
+            # both columns are read as strings so dirty values survive to the
+            # cleanup step, and the zero-copy arrow table feeds polars directly.
+            with blob.open('rb') as f:
+                table = pacsv.read_csv(
+                    f,
+                    read_options=pacsv.ReadOptions(block_size=8 << 20),
+                    convert_options=pacsv.ConvertOptions(
+                        include_columns=['OrganizationID', 'Total'],
+                        column_types={'OrganizationID': pa.string(), 'Total': pa.string()}
+                    )
+                )
+            df = pl.from_arrow(table)
+            logging.info("File processed successfully in memory.")
+            return df  # Return the DataFrame
 
         logging.warning(f"No file found for the date: {target_date}")
         return None
@@ -48,28 +105,57 @@ def download_and_process_csv_for_date(bucket_name, service_account_info, target_
         logging.error(f"An unexpected error occurred: {e}")
     return None
 
-def fetch_planhat_companies(api_token, limit=500):
+def fetch_planhat_companies(api_token, limit=500, service_account_json=None, cache_bucket=None):
     """
-    Fetches a single batch of companies from Planhat with a limit on the number of companies.
-    
+    Fetches all companies from Planhat, downloading the pages concurrently.
+
+    When a cache bucket is configured, the day's company list is cached in GCS
+    as parquet so repeat runs skip the Planhat round-trip and survive outages.
+
     Parameters:
     api_token (str): Planhat API token for authentication.
-    limit (int): Maximum number of companies to fetch (default 500).
-    
+    limit (int): Page size used for the paginated requests (default 500).
+    service_account_json (str): Raw GCP service account JSON for the cache bucket.
+    cache_bucket (str): Name of the GCS bucket used for the daily cache.
+
     Returns:
     pd.DataFrame: A DataFrame containing the fetched companies' information.
     """
+    # Try the daily GCS cache first
+    cache_blob = None
+    if cache_bucket and service_account_json:
+        storage_client = _gcs_client(service_account_json)
+        cache_key = datetime.utcnow().strftime('%Y-%m-%d')
+        cache_blob = storage_client.bucket(cache_bucket).blob(f'planhat_companies/{cache_key}.parquet')
+        try:
+            df = pd.read_parquet(BytesIO(cache_blob.download_as_bytes()))
+            logging.info(f"Loaded {len(df)} companies from the daily cache.\n")
+            return df
+        except NotFound:
+            logging.info("No cached company list for today; fetching from Planhat.")
+        except Exception as e:
+            logging.warning(f"Could not read cached company list: {e}")
+
     url = 'https://api.planhat.com/companies'
     headers = {'Authorization': f'Bearer {api_token}'}
-    
+
     try:
-        logging.info("Fetching a single batch of companies from Planhat...")
-        
-        params = {'offset': 0, 'limit': limit}
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        
-        companies = response.json()
+        logging.info("Fetching companies from Planhat...")
+
+        # Read the total count first so the remaining pages can be fetched concurrently
+        head = SESSION.get(url, headers=headers, params={'offset': 0, 'limit': 1})
+        head.raise_for_status()
+        total = int(head.headers.get('X-Total-Count', 0)) or limit
+
+        def fetch_page(offset):
+            response = SESSION.get(url, headers=headers, params={'offset': offset, 'limit': limit})
+            response.raise_for_status()
+            return orjson.loads(response.content)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            pages = executor.map(fetch_page, range(0, total, limit))
+
+        companies = list(itertools.chain.from_iterable(pages))
 
         # Process the batch of companies
         batch_data = [{
@@ -78,28 +164,54 @@ def fetch_planhat_companies(api_token, limit=500):
             'Company Name': c.get('name')
         } for c in companies]
 
-        df = pd.DataFrame(batch_data)
+        # Explicit columns so an empty result still has the expected schema
+        df = pd.DataFrame(batch_data, columns=['Planhat ID', 'Org ID', 'Company Name'])
         logging.info(f"Successfully fetched {len(df)} companies.\n")
+
+        # Store today's list so subsequent runs can skip the API call
+        if cache_blob is not None:
+            try:
+                buf = BytesIO()
+                df.to_parquet(buf)
+                cache_blob.upload_from_string(buf.getvalue())
+            except Exception as e:
+                logging.warning(f"Could not write cached company list: {e}")
+
         return df
-    
+
     except Exception as e:
         logging.error(f"Error fetching companies from Planhat: {e}")
         return None
 
-def calculate_metrics(df_current, org_ids, data_date):
+def compute_org_totals(df_current):
     """
-    Calculates cumulative and forecasted billable CPUs.
+    Cleans the billing data once and returns the total CPUs summed per Org ID.
+
+    The cleaning and group-by run inside polars' native engine; the result is
+    returned as a pandas Series indexed by the normalized Org ID so lookups
+    stay O(1) per company.
     """
-    # Ensure Org IDs are strings and cleaned
-    org_ids = [str(org_id).strip().lower() for org_id in org_ids]
+    totals = (
+        df_current.lazy()
+        .with_columns(
+            pl.col('OrganizationID').str.strip_chars().str.to_lowercase(),
+            pl.col('Total').cast(pl.Float64, strict=False).fill_null(0.0)
+        )
+        .group_by('OrganizationID')
+        .agg(pl.col('Total').sum())
+        .collect()
+    )
+    return totals.to_pandas().set_index('OrganizationID')['Total']
 
-    # Clean and convert 'OrganizationID' in DataFrame
-    df_current['OrganizationID'] = df_current['OrganizationID'].astype(str).str.strip().str.lower()
-    df_current['Total'] = pd.to_numeric(df_current['Total'], errors='coerce').fillna(0)
+def calculate_metrics(totals, org_ids, data_date):
+    """
+    Calculates cumulative and forecasted billable CPUs from the per-org totals.
 
-    # Filter data for the organization IDs
-    df_current_org = df_current[df_current['OrganizationID'].isin(org_ids)]
-    cumulative_total = df_current_org['Total'].sum()
+    Org IDs are expected to already be normalized (stripped, lowercased) to
+    match the totals index.
+    """
+    # Sum the precomputed per-org totals for the organization IDs
+    cumulative_total = totals.reindex(list(org_ids)).fillna(0).sum()
 
     # Forecasted billable CPUs
     days_passed = data_date.day
@@ -112,59 +224,115 @@ def calculate_metrics(df_current, org_ids, data_date):
 
     return round(cumulative_total, 2), round(forecasted_cpus, 2)
 
-def update_planhat(api_token, company_id, org_id, date_str, cumulative_cpus, forecasted_cpus, company_name):
+# Templates for the two dimension records built per company; copying a
+# prebuilt dict and filling the three varying fields is cheaper than
+# re-executing the full dict literals in the hot loop
+_CUMULATIVE_TEMPLATE = {
+    "dimensionId": "Cumulative Billable CPUs",
+    "value": None,
+    "externalId": None,
+    "model": "Asset",
+    "date": None
+}
+_FORECASTED_TEMPLATE = {
+    "dimensionId": "Forecasted Billable CPUs",
+    "value": None,
+    "externalId": None,
+    "model": "Asset",
+    "date": None
+}
+
+def build_planhat_payload(org_id, date_str, cumulative_cpus, forecasted_cpus):
+    """
+    Builds the two dimension data records (cumulative and forecasted) for one company.
+
+    date_str is expected to already be formatted as '%Y-%m-%d'.
+    """
+    cumulative = _CUMULATIVE_TEMPLATE.copy()
+    cumulative['value'] = cumulative_cpus
+    cumulative['externalId'] = org_id
+    cumulative['date'] = date_str
+
+    forecasted = _FORECASTED_TEMPLATE.copy()
+    forecasted['value'] = forecasted_cpus
+    forecasted['externalId'] = org_id
+    forecasted['date'] = date_str
+
+    return [cumulative, forecasted]
+
+async def _post_dimension_chunk(session, url, headers, chunk):
+    """
+    Posts one batch of dimension records, retrying transient failures with
+    exponential backoff (the aiohttp path bypasses the shared session's Retry).
+    """
+    for attempt in range(PLANHAT_UPLOAD_RETRIES):
+        try:
+            # orjson serializes the batch body ~10x faster than stdlib json;
+            # OPT_SERIALIZE_NUMPY handles the numpy scalars coming out of the
+            # pandas totals (orjson rejects them by default, unlike stdlib json)
+            body = orjson.dumps(chunk, option=orjson.OPT_SERIALIZE_NUMPY)
+            async with session.post(url, headers=headers, data=body) as response:
+                response.raise_for_status()
+                logging.info("Planhat batch uploaded successfully.")
+                return
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Non-transient response statuses (400/401/403/...) won't change on
+            # retry, so only the statuses in the shared Retry policy are retried
+            non_retryable = (
+                isinstance(e, aiohttp.ClientResponseError)
+                and e.status not in PLANHAT_RETRY_STATUSES
+            )
+            if non_retryable or attempt == PLANHAT_UPLOAD_RETRIES - 1:
+                logging.error(f"Error uploading dimension data batch to Planhat: {e}")
+                return
+            await asyncio.sleep(PLANHAT_UPLOAD_BACKOFF * (2 ** attempt))
+
+async def _upload_dimension_chunks(url, headers, chunks):
+    connector = aiohttp.TCPConnector(limit=PLANHAT_UPLOAD_CONNECTIONS)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*[
+            _post_dimension_chunk(session, url, headers, chunk) for chunk in chunks
+        ])
+
+def upload_planhat_dimension_data(api_token, payload, batch_size=PLANHAT_BATCH_SIZE):
     """
-    Updates Planhat with the cumulative and forecasted metrics.
+    Uploads all dimension data records to Planhat in chunked, concurrent POSTs.
+
+    Batching keeps the number of requests at O(len(payload) / batch_size) instead
+    of O(companies), and the chunks are independent so they are posted on an
+    asyncio event loop to overlap network latency without thread switching.
     """
     planhat_tenant_id = '8fbda5b0-f5fd-4d6f-86e2-1d9eecf0322a'
     # planhat_tenant_id = os.getenv('PLANHAT_TENANT_TOKEN')
-    
+
     url = f'https://analytics.planhat.com/dimensiondata/{planhat_tenant_id}'
     headers = {
         'Authorization': f'Bearer {api_token}',
         'Content-Type': 'application/json'
     }
 
-    upload_date = datetime.strptime(date_str, '%Y-%m-%d')
-
-    data = [
-        {
-            "dimensionId": "Cumulative Billable CPUs",
-            "value": cumulative_cpus,
-            "externalId": org_id,
-            "model": "Asset",
-            "date": upload_date.strftime('%Y-%m-%d')
-        },
-        {
-            "dimensionId": "Forecasted Billable CPUs",
-            "value": forecasted_cpus,
-            "externalId": org_id,
-            "model": "Asset",
-            "date": upload_date.strftime('%Y-%m-%d')
-        }
-    ]
-
+    chunks = [payload[i:i + batch_size] for i in range(0, len(payload), batch_size)]
+    logging.info(f"Uploading {len(payload)} dimension records to Planhat in {len(chunks)} batches...")
     try:
-        logging.info(f"Updating Planhat for Company Name: {company_name}")
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
-        logging.info(f"Planhat updated successfully for Company Name: {company_name}")
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Error updating Planhat for Company Name: {company_name}, {e}")
-    logging.info("\n")
+        asyncio.run(_upload_dimension_chunks(url, headers, chunks))
+    except Exception as e:
+        # Degrade like every other failure path in this module instead of
+        # crashing pull_and_update with an unhandled traceback
+        logging.error(f"Error uploading dimension data to Planhat: {e}")
 
 def pull_and_update(request):
     # Configuration
 
-    service_account_json_str = os.getenv('GCP_SERVICE_ACCOUNT_JSON')
-    service_account_info = json.loads(service_account_json_str)
-    
+    # Kept as the raw string; _gcs_client parses it once per instance
+    service_account_json = os.getenv('GCP_SERVICE_ACCOUNT_JSON')
+
     api_token = os.getenv('PLANHAT_API_TOKEN')
     planhat_tenant_id = os.getenv('PLANHAT_TENANT_TOKEN')
     bucket_name = os.getenv('BILLING_BUCKET_NAME')
+    cache_bucket = os.getenv('PLANHAT_CACHE_BUCKET')  # optional daily company-list cache
 
     # Ensure configuration variables are set
-    if not bucket_name or not service_account_info or not api_token:
+    if not bucket_name or not service_account_json or not api_token:
         logging.error("Environment variables GCP_BUCKET_NAME, GCP_SERVICE_ACCOUNT_JSON, or PLANHAT_API_TOKEN are not set.")
         return "Env var configuration error", 500
 
@@ -174,13 +342,13 @@ def pull_and_update(request):
     date_str = data_date.strftime('%Y-%m-%d')
 
     # Download current day's data
-    df_current = download_and_process_csv_for_date(bucket_name, service_account_info, execution_date.strftime('%Y-%m-%d'))
+    df_current = download_and_process_csv_for_date(bucket_name, service_account_json, execution_date.strftime('%Y-%m-%d'))
     if df_current is None:
         logging.error("Current day's data not available. Exiting.")
         return "CSV data not available", 500
 
     # Fetch companies from Planhat (as in original)
-    df_companies = fetch_planhat_companies(api_token)
+    df_companies = fetch_planhat_companies(api_token, service_account_json=service_account_json, cache_bucket=cache_bucket)
     if df_companies is None:
         logging.error("Failed to fetch companies from Planhat. Exiting.")
         return "Failed to fetch companies", 500
@@ -191,41 +359,63 @@ def pull_and_update(request):
         {'551cf481-0042-4076-a5a1-a78e23193c84', 'c116cabe-9d57-46c3-b37b-a93e8f52967e'}, # OneTrust
     ]
 
-    # Process each company
-    for _, company in df_companies.iterrows():
-        company_org_id = company['Org ID']
-        company_name = company['Company Name']
-        planhat_id = company['Planhat ID']
+    # Invert the sets into a dict so finding a company's set is one hash lookup,
+    # with keys normalized once to match the cleaned billing data
+    org_lookup = {
+        str(org_id).strip().lower(): frozenset(str(o).strip().lower() for o in org_set)
+        for org_set in org_id_sets
+        for org_id in org_set
+    }
+
+    # Clean the billing data and sum totals per org once, instead of per company
+    totals = compute_org_totals(df_current)
+
+    # Memoize metrics per org-id set so companies sharing a set (Provenir,
+    # OneTrust) don't recompute the same reindex + sum
+    @lru_cache(maxsize=None)
+    def metrics_for(org_ids_key):
+        return calculate_metrics(totals, org_ids_key, data_date)
+
+    # Accumulate dimension records for all companies into a single payload
+    payload = []
+
+    # Process each company; itertuples avoids allocating a Series per row
+    company_rows = df_companies[['Planhat ID', 'Org ID', 'Company Name']]
+    for planhat_id, company_org_id, company_name in company_rows.itertuples(index=False, name=None):
         if not company_org_id:
-            logging.warning(f"Company '{company_name}' does not have an Org ID. Skipping.")
+            logging.warning("Company '%s' does not have an Org ID. Skipping.", company_name)
             continue
 
         # Determine if the company_org_id is in any of the org_id_sets
-        matching_set = None
-        for org_set in org_id_sets:
-            if company_org_id in org_set:
-                matching_set = org_set
-                break
+        normalized_org_id = str(company_org_id).strip().lower()
+        matching_set = org_lookup.get(normalized_org_id)
 
+        # Per-company messages are DEBUG so the hot loop doesn't format and
+        # emit several records per row on normal INFO runs; %s-style arguments
+        # keep the formatting lazy when the level is filtered out
         if matching_set:
             org_ids = matching_set
-            logging.info(f"Company '{company_name}' uses multiple Org IDs: {org_ids}")
+            logging.debug("Company '%s' uses multiple Org IDs: %s", company_name, org_ids)
         else:
-            org_ids = [company_org_id]
-            logging.info(f"Company '{company_name}' uses single Org ID: {company_org_id}")
+            org_ids = [normalized_org_id]
+            logging.debug("Company '%s' uses single Org ID: %s", company_name, company_org_id)
 
         # Calculate metrics
-        cumulative_cpus, forecasted_cpus = calculate_metrics(df_current, org_ids, data_date)
+        cumulative_cpus, forecasted_cpus = metrics_for(frozenset(org_ids))
+
+        logging.debug(
+            "Company: %s, Date: %s, Cumulative CPUs: %s, Forecasted CPUs: %s",
+            company_name, date_str, cumulative_cpus, forecasted_cpus
+        )
+
+        # Collect the records; the upload happens in batches after the loop
+        payload.extend(build_planhat_payload(company_org_id, date_str, cumulative_cpus, forecasted_cpus))
 
-        # Print the results
-        logging.info(f"Company: {company_name}")
-        logging.info(f"Date: {date_str}")
-        logging.info(f"Cumulative CPUs: {cumulative_cpus}")
-        logging.info(f"Forecasted CPUs: {forecasted_cpus}")
+    # One run-level summary instead of several INFO records per company
+    logging.info("Calculated metrics for %d companies.", len(payload) // 2)
 
-        # Update Planhat with cumulative and forecasted CPUs
-        update_planhat(api_token, planhat_id, company_org_id, date_str, cumulative_cpus, forecasted_cpus, company_name)
-        time.sleep(1)
+    # Upload all records in chunked POSTs instead of one POST per company
+    upload_planhat_dimension_data(api_token, payload)
 
     logging.info("Script completed successfully.")
     return "Success", 200
\ No newline at end of file